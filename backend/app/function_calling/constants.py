@@ -1,3 +1,21 @@
+import os
+
+# Maximum number of tool rounds (follow-up model requests) within a single response
+MAX_TOOL_TURNS = int(os.getenv("MAX_TOOL_TURNS", "20"))
+
+# Maximum number of tool follow-up requests in flight at once across all responses
+MAX_CONCURRENT_TOOL_TURNS = int(os.getenv("MAX_CONCURRENT_TOOL_TURNS", "16"))
+
+# Maximum number of tool calls from a single model turn executed at the same time
+MAX_PARALLEL_TOOL_CALLS = int(os.getenv("MAX_PARALLEL_TOOL_CALLS", "4"))
+
+# Read-only local tools whose results may be reused for identical arguments
+CACHEABLE_TOOLS = frozenset({"web_search", "web_browsing", "analyze_web_page_content"})
+
+# How long (seconds) a cached tool result stays valid, and how many results are kept
+TOOL_RESULT_CACHE_TTL = int(os.getenv("TOOL_RESULT_CACHE_TTL", "300"))
+TOOL_RESULT_CACHE_SIZE = 256
+
 # Tool use instruction
 TOOL_USE_INSTRUCTION = r"""
 You have access to a flexible toolkit that can include web search & browsing, document readers, calculators, code runners, schedulers, image tools, and more.  
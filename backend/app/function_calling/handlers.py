@@ -1,5 +1,6 @@
-from typing import Any, Dict, List, AsyncGenerator, Union
+from typing import Any, Dict, List, AsyncGenerator, Optional, Tuple, Union
 import json
+import time
 import inspect
 from sqlalchemy.orm import Session # DBアクセス用
 from app.infrastructure.database import SessionLocal # DBセッション取得用
@@ -9,6 +10,7 @@ from app.application.settings.service import SettingsService # 設定サービ
 from app.logger.logging_utils import get_logger, log_error, log_info, log_warning, log_debug
 # Import the dynamic tool discovery function
 from app.function_calling.definitions import get_available_tools
+from app.function_calling.constants import CACHEABLE_TOOLS, TOOL_RESULT_CACHE_TTL, TOOL_RESULT_CACHE_SIZE
 
 from poly_mcp_client import PolyMCPClient
 
@@ -19,6 +21,61 @@ logger = get_logger()
 # Note: @lru_cache on get_available_tools ensures this scan happens only once (per cache settings)
 tool_functions_map = {func.__name__: func for func in get_available_tools()}
 
+# Results of read-only local tools: (tool name, canonical arguments) -> (expiry time, result blocks)
+_tool_result_cache: Dict[Tuple[str, str], Tuple[float, List[Dict[str, Any]]]] = {}
+
+# Prefix of the error strings returned by the web browsing tools instead of raising
+_TOOL_ERROR_PREFIX = "Error"
+
+def _get_cached_tool_result(cache_key: Tuple[str, str]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Look up a cached tool result, dropping it if it has expired.
+
+    Args:
+        cache_key: The (tool name, canonical arguments) key
+
+    Returns:
+        The cached result blocks, or None if there is no valid entry
+    """
+    entry = _tool_result_cache.get(cache_key)
+    if entry is None:
+        return None
+    expires_at, result = entry
+    if expires_at < time.monotonic():
+        del _tool_result_cache[cache_key]
+        return None
+    return result
+
+def _is_cacheable_result(result: Any) -> bool:
+    """
+    Check whether a local tool result is worth caching.
+
+    Only non-empty text or dict results are cached; empty results, web_search's
+    error list and formatted "Error ..." strings are transient failures.
+
+    Args:
+        result: The raw return value of the tool function
+
+    Returns:
+        True if the result may be served to later identical calls
+    """
+    if isinstance(result, dict):
+        return bool(result)
+    return isinstance(result, str) and bool(result.strip()) and not result.startswith(_TOOL_ERROR_PREFIX)
+
+def _cache_tool_result(cache_key: Tuple[str, str], result: List[Dict[str, Any]]) -> None:
+    """
+    Store a copy of a tool result, evicting the oldest entry when the cache is full.
+
+    Args:
+        cache_key: The (tool name, canonical arguments) key
+        result: The result blocks to cache
+    """
+    _tool_result_cache.pop(cache_key, None)
+    if len(_tool_result_cache) >= TOOL_RESULT_CACHE_SIZE:
+        del _tool_result_cache[next(iter(_tool_result_cache))]
+    _tool_result_cache[cache_key] = (time.monotonic() + TOOL_RESULT_CACHE_TTL, [dict(block) for block in result])
+
 async def handle_tool_call(
     tool_name: str,
     tool_input: Dict[str, Any],
@@ -35,7 +92,8 @@ async def handle_tool_call(
     Yields:
         Tool execution status updates for frontend
     Returns:
-        The tool execution results will be returned via the last yielded status update
+        The tool execution results will be returned via the last yielded status update,
+        as a list of Anthropic-style content blocks (text / base64 image)
     """
     result = None
     result_to_return = []
@@ -102,21 +160,33 @@ async def handle_tool_call(
                     else:
                         log_warning(f"Ignoring invalid parameter '{key}' for tool '{tool_name}'")
                 
+                # Read-only tools reuse a recent result for identical arguments
+                cache_key = None
+                if tool_name in CACHEABLE_TOOLS:
+                    cache_key = (tool_name, json.dumps(valid_params, sort_keys=True, default=str))
+
                 try:
-                    # ローカルツール実行 (既存ロジック)
-                    result = await tool_func(**valid_params)
-                    log_info(f"Local tool execution complete: {tool_name}")
-                    if isinstance(result, dict):
-                        result_to_return.append({"type": "text", "text": json.dumps(result)})
+                    cached_result = _get_cached_tool_result(cache_key) if cache_key else None
+                    if cached_result is not None:
+                        log_info(f"Using cached result for tool: {tool_name}")
+                        result_to_return.extend(dict(block) for block in cached_result)
                     else:
-                        result_to_return.append({"type": "text", "text": result})
+                        # ローカルツール実行 (既存ロジック)
+                        result = await tool_func(**valid_params)
+                        log_info(f"Local tool execution complete: {tool_name}")
+                        if isinstance(result, dict):
+                            result_to_return.append({"type": "text", "text": json.dumps(result)})
+                        else:
+                            result_to_return.append({"type": "text", "text": result})
+                        if cache_key and _is_cacheable_result(result):
+                            _cache_tool_result(cache_key, result_to_return)
 
                     # Return the final result in the last status update
                     if result_to_return: # Check for None explicitly, as some tools might return False/0
-                        yield {"type": "tool_execution_complete", "tool": tool_name, "result": json.dumps(result_to_return)}
+                        yield {"type": "tool_execution_complete", "tool": tool_name, "result": result_to_return}
                     else:
                         log_warning(f"Local Tool execution completed, but no result was returned: {tool_name}")
-                        yield {"type": "tool_execution_complete", "tool": tool_name, "result": "Tool execution completed, but no result was returned."}
+                        yield {"type": "tool_execution_complete", "tool": tool_name, "result": [{"type": "text", "text": "Tool execution completed, but no result was returned."}]}
 
                 except Exception as e:
                     log_error(f"Error executing local tool: {str(e)}", {"tool": tool_name, "input": tool_input})
@@ -132,7 +202,7 @@ async def handle_tool_call(
             log_warning(f"Tool execution completed, but no result was returned: {tool_name}")
             result_to_return.append({"type": "text", "text": f"{tool_name} execution completed, but no result was returned."})
 
-        yield {"type": "tool_execution_complete", "tool": tool_name, "result": json.dumps(result_to_return)}
+        yield {"type": "tool_execution_complete", "tool": tool_name, "result": result_to_return}
 
 
     except Exception as e:
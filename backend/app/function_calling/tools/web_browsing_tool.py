@@ -357,7 +357,7 @@ code block in code block will be escaped with backticks (e.g., \`\`\`).
                 text += chunk.text
 
             if chunk.usage_metadata:
-                usage = await parse_usage_gemini(chunk.usage_metadata)
+                usage = parse_usage_gemini(chunk.usage_metadata)
                 log_info("Token usage in web extraction", usage)
 
             break
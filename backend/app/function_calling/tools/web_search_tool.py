@@ -187,7 +187,7 @@ async def web_search(query: str, num_results: int = 5) -> str:
         metadata = response.candidates[0].grounding_metadata
 
         if response.usage_metadata:
-            usage = await parse_usage_gemini(response.usage_metadata)
+            usage = parse_usage_gemini(response.usage_metadata)
             log_info("Token usage in web search", usage)
 
         if not metadata:
@@ -4,7 +4,6 @@ from anthropic import AsyncAnthropic
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 import base64
-from google import genai
 from google.genai.types import (
     ToolConfig,
     FunctionCallingConfig,
@@ -49,10 +48,18 @@ from app.function_calling.definitions import (
 )
 from app.function_calling.constants import TOOL_USE_INSTRUCTION
 from app.logger.logging_utils import log_info, log_error, log_warning
+from app.infrastructure.http_client import get_http_client, get_gemini_client
 
 # 定数 (仮ユーザーID)
 TEMP_USER_ID = 1
 
+# Headers for SSE responses: the generators already yield encoded bytes, these keep
+# intermediaries (browser caches, nginx proxy buffering) from holding frames back
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
 
 class ChatHandler:
     def __init__(self, api_key: str, settings_service: SettingsService):
@@ -89,7 +96,7 @@ class ChatHandler:
         If a BadRequest error indicates that stream mode is unsupported,
         the generation falls back to non-streaming mode using common logic.
         """
-        openai = AsyncOpenAI(api_key=self.api_key)
+        openai = AsyncOpenAI(api_key=self.api_key, http_client=get_http_client())
         openai_messages = await prepare_openai_messages(system, messages)
 
         completion_args = {
@@ -126,7 +133,8 @@ class ChatHandler:
                         mcp_manager=mcp_manager,
                         enabled_tools=enabled_tools
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 # If the error indicates that stream mode is unsupported, fall back.
@@ -144,7 +152,8 @@ class ChatHandler:
                             mcp_manager=mcp_manager,
                             enabled_tools=enabled_tools
                         ),
-                        media_type="text/event-stream"
+                        media_type="text/event-stream",
+                        headers=SSE_HEADERS
                     )
                 else:
                     log_error(f"OpenAI API error (stream): {e}", {"model": model, "stream": True})
@@ -161,7 +170,8 @@ class ChatHandler:
                         mcp_manager=mcp_manager,
                         enabled_tools=enabled_tools
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"OpenAI API error (non-stream): {e}", {"model": model, "stream": False})
@@ -186,7 +196,7 @@ class ChatHandler:
         image_generation: bool = False
     ) -> Any:
         """Handle Anthropic API requests"""
-        anthropic = AsyncAnthropic(api_key=self.api_key)
+        anthropic = AsyncAnthropic(api_key=self.api_key, http_client=get_http_client())
         anthropic_messages = await prepare_anthropic_messages(messages)
 
         params = {
@@ -241,7 +251,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"Anthropic API error (stream): {e}", {"model": model, "stream": True})
@@ -258,7 +269,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"Anthropic API error (non-stream): {e}", {"model": model, "stream": False})
@@ -283,7 +295,7 @@ class ChatHandler:
         image_generation: bool = False
     ) -> Any:
         """Handle Gemini API requests using the new client"""
-        client = genai.Client(api_key=self.api_key)
+        client = get_gemini_client(self.api_key)
         
         safety_settings = [
             SafetySetting(
@@ -449,7 +461,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"Gemini API error (stream): {e}", {"model": model, "stream": True})
@@ -474,7 +487,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"Gemini API error (non-stream): {e}", {"model": model, "stream": False})
@@ -505,7 +519,8 @@ class ChatHandler:
         """
         xai = AsyncOpenAI(
             api_key=self.api_key,
-            base_url="https://api.x.ai/v1"
+            base_url="https://api.x.ai/v1",
+            http_client=get_http_client()
         )
         xai_messages = await prepare_openai_messages(system, messages)
 
@@ -544,7 +559,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 # If the error indicates that stream mode is unsupported, fall back.
@@ -562,7 +578,8 @@ class ChatHandler:
                             enabled_tools=enabled_tools,
                             multimodal=multimodal
                         ),
-                        media_type="text/event-stream"
+                        media_type="text/event-stream",
+                        headers=SSE_HEADERS
                     )
                 else:
                     log_error(f"XAI API error (stream): {e}", {"model": model, "stream": True})
@@ -580,7 +597,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"XAI API error (non-stream): {e}", {"model": model, "stream": False})
@@ -607,7 +625,8 @@ class ChatHandler:
         """Handle OpenRouter API requests"""
         openrouter = AsyncOpenAI(
             api_key=self.api_key,
-            base_url="https://openrouter.ai/api/v1"
+            base_url="https://openrouter.ai/api/v1",
+            http_client=get_http_client()
         )
 
         openrouter_messages = await prepare_openai_messages(system, messages)
@@ -658,7 +677,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 )
             except Exception as e:
                 log_error(f"OpenRouter API error (stream): {e}", {"model": model, "stream": True})
@@ -674,7 +694,8 @@ class ChatHandler:
                         enabled_tools=enabled_tools,
                         multimodal=multimodal
                     ),
-                    media_type="text/event-stream"
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
                 ) 
             except Exception as e:
                 log_error(f"OpenRouter API error (non-stream): {e}", {"model": model, "stream": False})
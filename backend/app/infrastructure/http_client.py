@@ -0,0 +1,87 @@
+"""
+共有HTTPクライアント
+
+プロバイダSDK (OpenAI / Anthropic) が共通で使用する httpx.AsyncClient と
+APIキーごとの Gemini クライアントの管理
+"""
+from collections import OrderedDict
+from typing import Optional
+import httpx
+from google import genai
+from google.genai.types import HttpOptions
+
+# Pool limits for all upstream LLM API connections; idle connections are kept for tool-call rounds
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=300)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Connection pool shared by every cached Gemini client; the clients own no connections themselves
+_gemini_transport: Optional[httpx.AsyncHTTPTransport] = None
+
+# Gemini clients by API key, least recently used first
+_gemini_clients: "OrderedDict[str, genai.Client]" = OrderedDict()
+
+# Maximum number of API keys with a cached Gemini client
+GEMINI_CLIENT_CACHE_SIZE = 16
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide httpx client, creating it on first use.
+    SDK clients are created per request; passing this client to them lets
+    keep-alive connections be reused across requests and tool-call rounds.
+
+    Returns:
+        Shared httpx.AsyncClient instance
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        # HTTP/2 multiplexes concurrent streams to the same provider over one TLS connection
+        _http_client = httpx.AsyncClient(limits=HTTP_POOL_LIMITS, http2=True, follow_redirects=True)
+    return _http_client
+
+def get_gemini_client(api_key: str) -> genai.Client:
+    """
+    Get the Gemini client for an API key, creating it on first use.
+    genai.Client cannot take an external httpx client and builds new httpx
+    clients and an SSL context on construction, so it is reused per key. All
+    cached clients send their async requests through one shared transport;
+    when the cache is full the least recently used client is simply dropped,
+    since it has no connections of its own to close.
+
+    Args:
+        api_key: Gemini API key
+
+    Returns:
+        Cached genai.Client instance
+    """
+    global _gemini_transport
+    client = _gemini_clients.get(api_key)
+    if client is not None:
+        _gemini_clients.move_to_end(api_key)
+        return client
+
+    if _gemini_transport is None:
+        _gemini_transport = httpx.AsyncHTTPTransport(limits=HTTP_POOL_LIMITS, http2=True)
+
+    client = genai.Client(
+        api_key=api_key,
+        http_options=HttpOptions(async_client_args={"transport": _gemini_transport})
+    )
+    _gemini_clients[api_key] = client
+    if len(_gemini_clients) > GEMINI_CLIENT_CACHE_SIZE:
+        _gemini_clients.popitem(last=False)
+    return client
+
+async def close_http_client() -> None:
+    """
+    Close the shared httpx client and the Gemini connection pool.
+    """
+    global _http_client, _gemini_transport
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+    _gemini_clients.clear()
+    if _gemini_transport is not None:
+        await _gemini_transport.aclose()
+        _gemini_transport = None
@@ -1,5 +1,8 @@
+import atexit
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional, Any, Dict
 from fastapi import Request
 import json
@@ -7,6 +10,27 @@ import json
 # Global logger instance
 app_logger: Optional[logging.Logger] = None
 
+class _DeferredFormatQueueHandler(QueueHandler):
+    """
+    QueueHandler that enqueues records unformatted, so that message
+    formatting happens on the listener thread instead of the event loop.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class _JsonArg:
+    """
+    Log argument that serializes a dictionary only when the record is formatted.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value: Dict[str, Any]):
+        # Shallow snapshot; callers may keep updating their dictionary
+        self.value = dict(value)
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, indent=2, ensure_ascii=False)
+
 def get_logger() -> logging.Logger:
     """
     Get the global logger instance. If it hasn't been set up, create it.
@@ -43,7 +67,13 @@ def setup_logger(name: str, level: int = logging.INFO) -> logging.Logger:
         )
         handler.setFormatter(formatter)
         
-        logger.addHandler(handler)
+        # Format and write records from a background thread so logging never blocks the event loop
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        
+        logger.addHandler(_DeferredFormatQueueHandler(log_queue))
     
     return logger
 
@@ -103,8 +133,11 @@ def log_info(
         logger: Logger instance (optional, will use global logger if not provided)
     """
     logger = logger or get_logger()
+    # Skip the call entirely when the level is disabled
+    if not logger.isEnabledFor(logging.INFO):
+        return
     if additional_info:
-        logger.info(f"{message} - Additional Info: {json.dumps(additional_info, indent=2, ensure_ascii=False)}")
+        logger.info("%s - Additional Info: %s", message, _JsonArg(additional_info))
     else:
         logger.info(message)
 
@@ -122,8 +155,11 @@ def log_warning(
         logger: Logger instance (optional, will use global logger if not provided)
     """
     logger = logger or get_logger()
+    # Skip the call entirely when the level is disabled
+    if not logger.isEnabledFor(logging.WARNING):
+        return
     if additional_info:
-        logger.warning(f"{message} - Additional Info: {json.dumps(additional_info, indent=2, ensure_ascii=False)}")
+        logger.warning("%s - Additional Info: %s", message, _JsonArg(additional_info))
     else:
         logger.warning(message)
 
@@ -141,7 +177,10 @@ def log_debug(
         logger: Logger instance (optional, will use global logger if not provided)
     """
     logger = logger or get_logger()
+    # Skip the call entirely when the level is disabled
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
     if additional_info:
-        logger.debug(f"{message} - Additional Info: {json.dumps(additional_info, indent=2, ensure_ascii=False)}")
+        logger.debug("%s - Additional Info: %s", message, _JsonArg(additional_info))
     else:
         logger.debug(message) 
\ No newline at end of file
@@ -18,6 +18,7 @@ from app.application.settings.service import SettingsService
 from app.handlers.chat_handler import ChatHandler
 from app.handlers.file_handler import FileHandler
 from app.logger.logging_utils import get_logger, log_request_info, log_error, log_info
+from app.infrastructure.http_client import close_http_client
 
 # --- PolyMCPClientのインポート ---
 from poly_mcp_client import PolyMCPClient
@@ -85,6 +86,7 @@ async def lifespan(app: FastAPI):
     logger.info("FastAPI終了: MCP接続をクリーンアップ")
     await mcp_client_manager.shutdown()
     logger.info("MCPクリーンアップ完了。")
+    await close_http_client()
 
 
 # --- FastAPI アプリケーションインスタンス (lifespanを設定) ---
@@ -30,6 +30,17 @@ async def prepare_api_messages(messages: List[Message], multimodal: bool = False
         api_messages.append({"role": message.role, "content": content})
     return api_messages
 
+# Converters from internal content items to the OpenAI format, keyed by item type
+_OPENAI_CONVERTERS = {
+    "text": lambda item: {"type": "text", "text": item['text']},
+    "image": lambda item: {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{item['source']['media_type']};base64,{item['source']['data']}"
+        }
+    },
+}
+
 async def prepare_openai_messages(system_message: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Prepare messages specifically for OpenAI API format
@@ -45,17 +56,11 @@ async def prepare_openai_messages(system_message: str, messages: List[Dict[str,
     openai_messages = [{"role": "system", "content": system_message}]
     
     for msg in messages:
-        content = []
-        for item in msg['content']:
-            if item['type'] == 'text':
-                content.append({"type": "text", "text": item['text']})
-            if item['type'] == 'image':
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:{item['source']['media_type']};base64,{item['source']['data']}"
-                    }
-                })
+        content = [
+            converter(item)
+            for item in msg['content']
+            if (converter := _OPENAI_CONVERTERS.get(item['type']))
+        ]
         openai_messages.append({"role": msg['role'], "content": content})
     
     return openai_messages
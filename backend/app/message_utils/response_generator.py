@@ -1,10 +1,16 @@
+import os
 import json
+import re
 import base64
-from typing import AsyncGenerator, Any, Dict, List
+import asyncio
+import functools
+from contextlib import aclosing
+import orjson
+from typing import AsyncGenerator, Any, Callable, Dict, List
 from openai import AsyncOpenAI
 from anthropic import AsyncAnthropic
 from app.function_calling.handlers import handle_tool_call
-from app.function_calling.definitions import get_tool_definitions, get_gemini_tool_definitions, get_anthropic_tool_definitions
+from app.function_calling.constants import MAX_TOOL_TURNS, MAX_CONCURRENT_TOOL_TURNS, MAX_PARALLEL_TOOL_CALLS
 from app.message_utils.usage_parser import parse_usage, parse_usage_gemini, parse_usage_anthropic
 from app.logger.logging_utils import get_logger, log_error, log_info, log_warning, log_debug
 from app.misc_utils.image_utils import upload_image_to_gemini
@@ -24,6 +30,350 @@ from poly_mcp_client.models import CanonicalToolDefinition
 # Get logger instance
 logger = get_logger()
 
+# Shared cap on tool follow-up requests so runaway tool loops cannot saturate upstream connections
+_TOOL_TURN_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_TOOL_TURNS)
+
+# Gemini tool config for follow-up rounds; the model may answer or call further tools
+_AUTO_TOOL_CONFIG = ToolConfig(
+    function_calling_config=FunctionCallingConfig(mode='AUTO')
+)
+
+# Constant SSE frames
+_DONE = b'data: {"text": "[DONE]"}\n\n'
+_PING = b": ping\n\n"
+_IMAGE_END = b'data: {"type":"image_end"}\n\n'
+
+# Text coalescing for SSE writes; SSE_COALESCE_MS=0 sends each frame as soon as the next one is not ready
+_COALESCE_MAX_DELAY_MS = float(os.getenv("SSE_COALESCE_MS", "5"))
+_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "4096"))
+
+# Upstream pings are only forwarded when nothing else was written for this many seconds
+_PING_INTERVAL = 15
+
+# Prefix shared by every text delta frame produced by _sse({"text": ...}) and _text_frame()
+_TEXT_FRAME_PREFIX = b'data: {"text":'
+
+_DATA = b"data: "
+
+def _sse(payload: Any) -> bytes:
+    """
+    Encode a payload as a single SSE data frame.
+
+    Args:
+        payload: JSON-serializable payload to send to the frontend
+
+    Returns:
+        The encoded SSE frame
+    """
+    # orjson writes the first newline itself, so the frame is built with a single join
+    return b"".join((_DATA, orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE), b"\n"))
+
+# Text deltas up to this length are cached; they are mostly single tokens that repeat often
+_TEXT_FRAME_CACHE_MAX_LEN = 32
+
+@functools.lru_cache(maxsize=1024)
+def _cached_text_frame(text: str) -> bytes:
+    return _sse({"text": text})
+
+def _text_frame(text: str) -> bytes:
+    """
+    Encode a text delta as an SSE frame, reusing the encoded frame for short repeated deltas.
+
+    Args:
+        text: The text delta to send
+
+    Returns:
+        bytes: The encoded SSE frame
+    """
+    if len(text) <= _TEXT_FRAME_CACHE_MAX_LEN:
+        return _cached_text_frame(text)
+    return _sse({"text": text})
+
+# Constant parts of the tool call and image frames; only the variable fields go through orjson
+_TC_PREFIX = b'data: {"type":"tool_call_start","tool":'
+_TC_END_PREFIX = b'data: {"type":"tool_call_end","tool":'
+_TC_ID = b',"id":'
+_TC_INPUT = b',"input":'
+_IMAGE_START_PREFIX = b'data: {"type":"image_start","mime_type":'
+_IMAGE_CHUNK_PREFIX = b'data: {"type":"image_chunk","chunk":'
+_FRAME_SUFFIX = b'}\n\n'
+# Base64 output never needs JSON escaping, so encoded image bytes are spliced between these as is
+_IMAGE_CHUNK_OPEN = _IMAGE_CHUNK_PREFIX + b'"'
+_IMAGE_CHUNK_CLOSE = b'"' + _FRAME_SUFFIX
+
+def _tool_call_start(tool_name: str, tool_id: str | None = None) -> bytes:
+    """
+    Build the SSE frame announcing a tool call, encoding only the variable fields.
+
+    Args:
+        tool_name: The name of the tool being called
+        tool_id: The provider's tool call ID, if any
+
+    Returns:
+        bytes: The encoded SSE frame
+    """
+    if tool_id is None:
+        return _TC_PREFIX + orjson.dumps(tool_name) + _FRAME_SUFFIX
+    return _TC_PREFIX + orjson.dumps(tool_name) + _TC_ID + orjson.dumps(tool_id) + _FRAME_SUFFIX
+
+def _tool_call_end(tool_name: str, tool_input: Any = None) -> bytes:
+    """
+    Build the SSE frame marking the end of a tool call, encoding only the variable fields.
+
+    Args:
+        tool_name: The name of the tool that was called
+        tool_input: The parsed tool input to include, if any
+
+    Returns:
+        bytes: The encoded SSE frame
+    """
+    if tool_input is None:
+        return _TC_END_PREFIX + orjson.dumps(tool_name) + _FRAME_SUFFIX
+    return _TC_END_PREFIX + orjson.dumps(tool_name) + _TC_INPUT + orjson.dumps(tool_input) + _FRAME_SUFFIX
+
+async def _coalesce(
+    source: AsyncGenerator[bytes, None],
+    max_bytes: int = _COALESCE_MAX_BYTES,
+    max_delay_ms: float = _COALESCE_MAX_DELAY_MS
+) -> AsyncGenerator[bytes, None]:
+    """
+    Merge text frames that arrive back-to-back into a single write.
+
+    Text frames are buffered until the buffer reaches max_bytes or max_delay_ms
+    has passed since the first buffered frame. Any other frame (tool events, usage,
+    [DONE], errors) is sent immediately together with the buffered text.
+    Keep-alive pings are dropped unless nothing was written for _PING_INTERVAL seconds.
+    The next frame is requested from the source while the current write is in flight.
+
+    Args:
+        source: Generator yielding complete SSE frames
+        max_bytes: Buffer size that triggers an immediate flush
+        max_delay_ms: Maximum time a text frame may wait in the buffer
+
+    Yields:
+        One or more complete SSE frames per write
+    """
+    loop = asyncio.get_running_loop()
+    max_delay = max_delay_ms / 1000
+    buffer = bytearray()
+    deadline = 0.0
+    last_write = loop.time()
+    next_frame = asyncio.ensure_future(anext(source))
+    try:
+        while next_frame is not None:
+            if buffer:
+                done, _ = await asyncio.wait((next_frame,), timeout=deadline - loop.time())
+                if not done:
+                    # Nothing else arrived in time; send what we have
+                    yield bytes(buffer)
+                    buffer.clear()
+                    last_write = loop.time()
+                    continue
+            try:
+                frame = await next_frame
+            except StopAsyncIteration:
+                next_frame = None
+                break
+            except Exception:
+                next_frame = None
+                if buffer:
+                    yield bytes(buffer)
+                raise
+            next_frame = asyncio.ensure_future(anext(source))
+
+            if frame.startswith(_TEXT_FRAME_PREFIX):
+                if not buffer:
+                    deadline = loop.time() + max_delay
+                buffer += frame
+                if len(buffer) < max_bytes:
+                    continue
+            elif frame is _PING and loop.time() - last_write < _PING_INTERVAL:
+                # The connection is not idle; the ping adds nothing
+                continue
+            else:
+                buffer += frame
+            yield bytes(buffer)
+            buffer.clear()
+            last_write = loop.time()
+
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        if next_frame is not None:
+            next_frame.cancel()
+            try:
+                await next_frame
+            except (asyncio.CancelledError, Exception):
+                pass
+        await source.aclose()
+
+def _coalesced(generator_func: Callable[..., AsyncGenerator[bytes, None]]) -> Callable[..., AsyncGenerator[bytes, None]]:
+    """Wrap an SSE generator function so its output goes through _coalesce."""
+    @functools.wraps(generator_func)
+    def wrapper(*args, **kwargs) -> AsyncGenerator[bytes, None]:
+        return _coalesce(generator_func(*args, **kwargs))
+    return wrapper
+
+async def _read_ahead(source: Any, max_items: int = 8) -> AsyncGenerator[Any, None]:
+    """
+    Iterate an upstream SDK stream from a background task.
+
+    The task keeps reading and parsing upstream events while the caller is
+    suspended on its own yields, so network reads overlap with sending frames
+    to the client. At most max_items events are buffered.
+
+    Args:
+        source: Async iterable of upstream events
+        max_items: Maximum number of events read ahead of the caller
+
+    Yields:
+        The upstream events in order
+    """
+    queue: asyncio.Queue = asyncio.Queue(max_items)
+    end = object()
+
+    async def _pump() -> None:
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(end)
+        except Exception as e:
+            # Hand the error to the consumer, which re-raises it in order
+            await queue.put(e)
+
+    task = asyncio.create_task(_pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop the pump before the caller closes or replaces the upstream stream
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+async def _run_tool_calls(
+    tool_calls: List[tuple[str, Any]],
+    mcp_manager: PolyMCPClient
+) -> AsyncGenerator[tuple[int, Dict[str, Any]], None]:
+    """
+    Execute several tool calls concurrently and merge their status updates.
+
+    At most MAX_PARALLEL_TOOL_CALLS tools run at once. Identical calls (same tool
+    name and input) within the turn are executed once and their status updates
+    are repeated for every duplicate. If a tool call raises, the error is re-raised
+    once all status updates have been delivered.
+
+    Args:
+        tool_calls: (tool name, tool input) pairs from a single model turn
+        mcp_manager: The PolyMCPClient instance for executing external tools
+
+    Yields:
+        (index into tool_calls, status update) pairs in the order they arrive
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_TOOL_CALLS)
+
+    # Group identical calls by their canonical JSON encoding
+    unique_calls: Dict[bytes, List[int]] = {}
+    for index, (tool_name, tool_input) in enumerate(tool_calls):
+        call_key = orjson.dumps([tool_name, tool_input], default=str, option=orjson.OPT_SORT_KEYS)
+        unique_calls.setdefault(call_key, []).append(index)
+
+    async def _drive(indices: List[int]) -> None:
+        tool_name, tool_input = tool_calls[indices[0]]
+        try:
+            async with semaphore:
+                async for status in handle_tool_call(tool_name, tool_input, mcp_manager):
+                    await queue.put((indices, status))
+        finally:
+            # Signal that this tool call has finished, successfully or not
+            await queue.put((indices, None))
+
+    tasks = [asyncio.create_task(_drive(indices)) for indices in unique_calls.values()]
+    try:
+        pending = len(tasks)
+        while pending:
+            indices, status = await queue.get()
+            if status is None:
+                pending -= 1
+                continue
+            for index in indices:
+                yield index, status
+        # Surface the first tool error, as the sequential loop did
+        await asyncio.gather(*tasks)
+    finally:
+        # Do not leave tools running for a consumer that has gone away
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Characters that can change the nesting state of a JSON document
+_JSON_STRUCTURAL_CHARS = re.compile(r'[{}"\\]')
+
+class _StreamedToolCall:
+    """
+    A tool call whose JSON arguments arrive in fragments over an OpenAI stream.
+    Tracks brace depth outside of string literals so completion is detected
+    from the new fragment only, without rescanning the accumulated arguments.
+    """
+    __slots__ = ("id", "name", "arguments", "complete", "_depth", "_in_string", "_escape_next")
+
+    def __init__(self, id: str, name: str):
+        self.id = id
+        self.name = name
+        self.arguments = bytearray()
+        self.complete = False
+        self._depth = 0
+        self._in_string = False
+        self._escape_next = False
+
+    def feed(self, fragment: str) -> bool:
+        """
+        Append an arguments fragment.
+
+        Args:
+            fragment: The next piece of the JSON arguments string
+
+        Returns:
+            True if this fragment closed the top-level JSON object
+        """
+        self.arguments += fragment.encode()
+        if self.complete:
+            return False
+
+        depth = self._depth
+        in_string = self._in_string
+        escaped_pos = 0 if self._escape_next else -1
+        for match in _JSON_STRUCTURAL_CHARS.finditer(fragment):
+            pos = match.start()
+            char = match.group()
+            if in_string:
+                if pos == escaped_pos:
+                    continue
+                if char == '\\':
+                    escaped_pos = pos + 1
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    self.complete = True
+                    break
+
+        self._depth = depth
+        self._in_string = in_string
+        self._escape_next = escaped_pos == len(fragment)
+        return self.complete
+
+@_coalesced
 async def gemini_stream_generator(
     response: Any,
     gemini_client: Client,
@@ -34,7 +384,7 @@ async def gemini_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generate streaming response for Gemini API.
     Handles both regular text responses and function calls.
@@ -52,204 +402,227 @@ async def gemini_stream_generator(
     """
 
     # Insert helper function to process inline image data
-    async def _yield_inline_image(inline_data) -> AsyncGenerator[str, None]:
+    async def _yield_inline_image(inline_data) -> AsyncGenerator[bytes, None]:
         try:
             mime_type = inline_data.mime_type
             data = inline_data.data
+            # 64KB chunks; images up to this size (as base64) go out in a single frame
+            chunk_size = 65536
+            yield _IMAGE_START_PREFIX + orjson.dumps(mime_type) + _FRAME_SUFFIX
             # Check the type of data and encode if necessary
             if isinstance(data, bytes):
-                base64_data = base64.b64encode(data).decode('utf-8')
-            elif isinstance(data, str):
-                # Assume data is already a proper base64 encoded string
-                base64_data = data
+                # Encode block by block; 3/4 of chunk_size raw bytes encode to exactly chunk_size base64
+                # characters without padding, so the chunks concatenate to the same string as a single encode
+                raw_chunk_size = chunk_size // 4 * 3
+                raw_data = memoryview(data)
+                for i in range(0, len(raw_data), raw_chunk_size):
+                    yield _IMAGE_CHUNK_OPEN + base64.b64encode(raw_data[i:i + raw_chunk_size]) + _IMAGE_CHUNK_CLOSE
             else:
-                log_error(f"Unexpected type for inline_data.data: {type(data)}")
-                base64_data = str(data)
-
-            yield f"data: {json.dumps({'type': 'image_start', 'mime_type': mime_type})}\n\n"
-            chunk_size = 8192  # 8KB chunks
-            for i in range(0, len(base64_data), chunk_size):
-                chunk = base64_data[i:i + chunk_size]
-                yield f"data: {json.dumps({'type': 'image_chunk', 'chunk': chunk})}\n\n"
-            yield f"data: {json.dumps({'type': 'image_end'})}\n\n"
+                if isinstance(data, str):
+                    # Assume data is already a proper base64 encoded string
+                    base64_data = data
+                else:
+                    log_error(f"Unexpected type for inline_data.data: {type(data)}")
+                    base64_data = str(data)
+                for i in range(0, len(base64_data), chunk_size):
+                    chunk = base64_data[i:i + chunk_size]
+                    yield _IMAGE_CHUNK_PREFIX + orjson.dumps(chunk) + _FRAME_SUFFIX
+            yield _IMAGE_END
         except Exception as e:
             log_error(f"Error processing image data: {str(e)}")
 
     # Cleanup uploaded images
-    def _cleanup_images():
-        for image in images:
-            try:
-                gemini_client.files.delete(name=image.name)
-            except Exception as e:
-                print(f"Error deleting image: {e}")
+    async def _cleanup_images():
+        # Delete all uploads concurrently; a failed delete must not affect the others
+        results = await asyncio.gather(
+            *(gemini_client.aio.files.delete(name=image.name) for image in images),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log_error(f"Error deleting image: {result}")
 
     try:
+        text_frame = _text_frame  # Local alias for the per-chunk text path
         latest_usage = None
         should_continue = True
         tool_calls_count = 0
         # Create a running copy of completion args to maintain context
         running_args = completion_args.copy()
-        # Keep track of the conversation history
-        running_history = history.copy()
+        # Keep track of the conversation history; copied on the first tool round only
+        running_history = history
         
         while should_continue:  # Loop to handle recursive tool calls
-            text = ""
+            text_chunks = []
             has_function_call = False
 
-            async for event in response:
-                # Handle function calls if present
-                if hasattr(event, 'candidates') and event.candidates:
-                    if hasattr(event.candidates[0], 'content') and event.candidates[0].content:
-                        if event.candidates[0].content.parts:
-                            part = event.candidates[0].content.parts[0]
-
-                            if part.inline_data:
-                                async for inline_chunk in _yield_inline_image(part.inline_data):
-                                    yield inline_chunk
-
-                            if part.thought:
-                                yield f"data: {json.dumps({'text': part.thought})}\n\n"
-
-                            # Handle regular text content
-                            if part.text:
-                                text += event.text
-                                yield f"data: {json.dumps({'text': event.text})}\n\n"
-
-                            if part.function_call:
-                                has_function_call = True
-
-                                # Initialize parts lists
-                                function_call_parts = []
-                                function_response_parts = []
-                                text_parts = []
-
-                                # Add text parts if present
-                                if text:
-                                    text_parts.append(Part.from_text(text=text))
-
-                                # Handle function calls
-                                for function_call in event.function_calls:
-                                    # Notify about tool call start
-                                    yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': function_call.name})}\n\n"
-                                    
-                                    # Handle the tool call
-                                    tool_result = None
-                                    async for status in handle_tool_call(function_call.name, function_call.args, mcp_manager):
-                                        if status["type"] == "tool_execution_complete":
-                                            tool_result = status["result"]
-                                        else:
-                                            # Forward status updates to frontend
-                                            yield f"data: {json.dumps(status)}\n\n"
-
-                                    # Create function call part with the tool result
-                                    function_call_part = Part.from_function_call(
-                                        name=function_call.name,
-                                        args=function_call.args
-                                    )
-                                    function_call_parts.append(function_call_part)
-
-                                    for result in json.loads(tool_result):
-                                        if result["type"] == "text":
-                                            function_response_parts.append(
-                                                Part.from_function_response(
-                                                    name=function_call.name,
-                                                    response={"content": result}
-                                                )
-                                            )
-                                        elif result["type"] == "image" and multimodal:
-                                            # Base64エンコードされた文字列を取得
-                                            base64_data_string = result["source"]["data"]
-                                            decoded_data = base64.b64decode(base64_data_string)
-                                            mime_type = result["source"]["media_type"]
-                                            
-                                            # sizeが20MB未満かどうか判定
-                                            if len(decoded_data) > 20 * 1024 * 1024:
-                                                log_info("Uploading image via Files API")
-                                                uploaded_image = await upload_image_to_gemini(
-                                                    decoded_data,
-                                                    mime_type
-                                                )
-                                                function_response_parts.append(
-                                                    Part.from_uri(
-                                                        file_uri=uploaded_image.uri, 
-                                                        mime_type=mime_type
-                                                    )
-                                                )
-                                                images.append(uploaded_image)
+            async with aclosing(_read_ahead(response)) as events:
+                async for event in events:
+                    # Handle function calls if present
+                    candidates = getattr(event, 'candidates', None)
+                    if candidates:
+                        candidate = candidates[0]
+                        content = getattr(candidate, 'content', None)
+                        if content:
+                            parts = content.parts
+                            if parts:
+                                part = parts[0]
+
+                                # Handle regular text content first; it is by far the most common chunk.
+                                # The parts are joined directly because event.text runs model_dump on every part.
+                                if part.text and not part.thought:
+                                    if len(parts) == 1:
+                                        text = part.text
+                                    else:
+                                        text = "".join(p.text for p in parts if p.text and not p.thought)
+                                    text_chunks.append(text)
+                                    yield text_frame(text)
+
+                                elif part.inline_data:
+                                    async for inline_chunk in _yield_inline_image(part.inline_data):
+                                        yield inline_chunk
+
+                                elif part.thought:
+                                    yield _sse({'text': part.thought})
+
+                                elif part.function_call:
+                                    has_function_call = True
+
+                                    # Initialize parts lists
+                                    function_call_parts = []
+                                    function_response_parts = []
+                                    text_parts = []
+
+                                    # Add text parts if present
+                                    if text_chunks:
+                                        text_parts.append(Part.from_text(text="".join(text_chunks)))
+
+                                    # Handle function calls; independent calls from the same turn run concurrently
+                                    function_calls = event.function_calls
+                                    for function_call in function_calls:
+                                        # Notify about tool call start
+                                        yield _tool_call_start(function_call.name)
+
+                                    tool_results = [None] * len(function_calls)
+                                    async with aclosing(_run_tool_calls(
+                                        [(function_call.name, function_call.args) for function_call in function_calls],
+                                        mcp_manager
+                                    )) as tool_statuses:
+                                        async for index, status in tool_statuses:
+                                            if status["type"] == "tool_execution_complete":
+                                                tool_results[index] = status["result"]
                                             else:
+                                                # Forward status updates to frontend
+                                                yield _sse(status)
+
+                                    for function_call, tool_result in zip(function_calls, tool_results):
+                                        # Create function call part with the tool result
+                                        function_call_part = Part.from_function_call(
+                                            name=function_call.name,
+                                            args=function_call.args
+                                        )
+                                        function_call_parts.append(function_call_part)
+
+                                        for result in tool_result:
+                                            if result["type"] == "text":
                                                 function_response_parts.append(
-                                                    Part.from_bytes(
-                                                        data=decoded_data,
-                                                        mime_type=mime_type
+                                                    Part.from_function_response(
+                                                        name=function_call.name,
+                                                        response={"content": result}
                                                     )
                                                 )
+                                            elif result["type"] == "image" and multimodal:
+                                                # Base64エンコードされた文字列を取得
+                                                base64_data_string = result["source"]["data"]
+                                                decoded_data = base64.b64decode(base64_data_string)
+                                                mime_type = result["source"]["media_type"]
+                                            
+                                                # sizeが20MB未満かどうか判定
+                                                if len(decoded_data) > 20 * 1024 * 1024:
+                                                    log_info("Uploading image via Files API")
+                                                    uploaded_image = await upload_image_to_gemini(
+                                                        decoded_data,
+                                                        mime_type
+                                                    )
+                                                    function_response_parts.append(
+                                                        Part.from_uri(
+                                                            file_uri=uploaded_image.uri, 
+                                                            mime_type=mime_type
+                                                        )
+                                                    )
+                                                    images.append(uploaded_image)
+                                                else:
+                                                    function_response_parts.append(
+                                                        Part.from_bytes(
+                                                            data=decoded_data,
+                                                            mime_type=mime_type
+                                                        )
+                                                    )
 
 
-                                    yield f"data: {json.dumps({'type': 'tool_call_end', 'tool': function_call.name})}\n\n"
-
-                                # Create function call content
-                                function_call_content = Content(
-                                    role="model",
-                                    parts=text_parts + function_call_parts
-                                )
+                                        yield _tool_call_end(function_call.name)
 
-                                # Create function response content
-                                function_response_content = Content(
-                                    role="user",
-                                    parts=function_response_parts
-                                )
+                                    # Create function call content
+                                    function_call_content = Content(
+                                        role="model",
+                                        parts=text_parts + function_call_parts
+                                    )
 
-                                # Update running history with function call and response
-                                running_history.append(function_call_content)
-                                running_history.append(function_response_content)
+                                    # Create function response content
+                                    function_response_content = Content(
+                                        role="user",
+                                        parts=function_response_parts
+                                    )
 
-                                # Change tool config to AUTO
-                                tool_config = ToolConfig(
-                                    function_calling_config=FunctionCallingConfig(mode='AUTO')
-                                )
-                                running_args["tool_config"] = tool_config
+                                    # Update running history with function call and response
+                                    if running_history is history:
+                                        running_history = list(history)
+                                    running_history.append(function_call_content)
+                                    running_history.append(function_response_content)
 
-                                if tool_calls_count > 0:
-                                    running_args["tools"] = [get_gemini_tool_definitions(canonical_tools=enabled_tools)]
+                                    # Change tool config to AUTO
+                                    running_args["tool_config"] = _AUTO_TOOL_CONFIG
 
-                                tool_calls_count += 1
+                                    if tool_calls_count >= MAX_TOOL_TURNS:
+                                        raise Exception(f"Tool call limit reached ({MAX_TOOL_TURNS} turns)")
+                                    tool_calls_count += 1
 
-                                # Get new response incorporating tool results
-                                response = await gemini_client.aio.models.generate_content_stream(
-                                    model=model,
-                                    contents=running_history,
-                                    config=GenerateContentConfig(**running_args)
-                                )
+                                    # Get new response incorporating tool results
+                                    async with _TOOL_TURN_SEMAPHORE:
+                                        response = await gemini_client.aio.models.generate_content_stream(
+                                            model=model,
+                                            contents=running_history,
+                                            config=GenerateContentConfig(**running_args)
+                                        )
                                 
-                                break  # Break inner loop to start new response processing
+                                    break  # Break inner loop to start new response processing
 
-                            if event.candidates:
-                                if event.candidates[0].finish_reason:
+                                if candidate.finish_reason:
                                     if event.usage_metadata:
                                         latest_usage = event.usage_metadata
                     
-                else:
-                    if hasattr(event, 'prompt_feedback'):
-                        prompt_feedback: GenerateContentResponsePromptFeedback = event.prompt_feedback
+                    else:
+                        prompt_feedback: GenerateContentResponsePromptFeedback = getattr(event, 'prompt_feedback', None)
                         if prompt_feedback:
-                            yield f"data: {json.dumps({'text': prompt_feedback.model_dump_json()})}\n\n"
+                            yield _sse({'text': prompt_feedback.model_dump_json()})
 
             # If no function calls were made, we're done
             if not has_function_call:
                 should_continue = False
                 # Handle usage metadata if present
-                usage = await parse_usage_gemini(latest_usage)
+                usage = parse_usage_gemini(latest_usage)
                 log_info("Token usage in Gemini", usage)
-                yield f"data: {json.dumps(usage)}\n\n"
-                yield f"data: {json.dumps({'text': '[DONE]'})}\n\n"
-                _cleanup_images()
+                yield _sse(usage)
+                yield _DONE
+                await _cleanup_images()
                 break
 
     except Exception as e:
         log_error(f"Error in Gemini stream generator: {str(e)}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield _sse({'error': str(e)})
 
 
+@_coalesced
 async def openai_stream_generator(
     response: Any,
     openai_client: AsyncOpenAI,
@@ -258,7 +631,7 @@ async def openai_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generator for streaming OpenAI API responses.
     This function also handles tool_calls if present in the response.
@@ -273,180 +646,195 @@ async def openai_stream_generator(
         Streaming response data.
     """
     try:
-        tool_calls_buffer = {}
+        text_frame = _text_frame  # Local alias for the per-chunk text path
+        tool_calls_buffer = []  # Indexed by tool_call.index
         should_continue = True
         tool_calls_count = 0
         text_generated = False
-        # Create a running copy of completion args to maintain context
-        running_args = completion_args.copy()
+        # Copy the args and the message list we append to; the caller's messages stay untouched
+        running_args = {**completion_args, "messages": list(completion_args["messages"])}
+        stream = response
         
         while should_continue:  # Loop to handle recursive tool calls
             should_continue = False  # Reset flag, will be set to True if we need to continue
+            if stream is None:
+                # Get new response incorporating tool results
+                async with _TOOL_TURN_SEMAPHORE:
+                    stream = await openai_client.chat.completions.create(**running_args)
             log_info("Processing OpenAI stream")
             has_tool_call = False
-
-            async for chunk in response:
-                if chunk.choices:
-                    delta = chunk.choices[0].delta
-
-                    # Handle regular text content
-                    if hasattr(delta, 'content') and delta.content is not None:
-                        yield f"data: {json.dumps({'text': delta.content})}\n\n"
-                        text_generated = True
-
-                    # Handle tool calls
-                    if hasattr(delta, 'tool_calls') and delta.tool_calls:
-                        has_tool_call = True
-                        for tool_call in delta.tool_calls:
-                            index = tool_call.index
+            release_stream = False
+
+            async with aclosing(_read_ahead(stream)) as chunks:
+                async for chunk in chunks:
+                    choices = chunk.choices
+                    if choices:
+                        choice = choices[0]
+                        delta = choice.delta
+                        finish = choice.finish_reason
+                    else:
+                        delta = finish = None
+
+                    if delta is not None:
+                        # Handle regular text content; empty keep-alive deltas are not forwarded
+                        content = delta.content
+                        if content:
+                            yield text_frame(content)
+                            text_generated = True
+
+                        # Handle tool calls
+                        delta_tool_calls = delta.tool_calls
+                        if delta_tool_calls:
+                            has_tool_call = True
+                            for tool_call in delta_tool_calls:
+                                index = tool_call.index
+                                function = tool_call.function
                             
-                            if index not in tool_calls_buffer:
-                                tool_calls_buffer[index] = tool_call
-                                # First chunk of a tool call - we'll wait for full arguments before notifying
-                                if tool_call.function and tool_call.function.name:
-                                    yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': tool_call.function.name, 'id': tool_call.id})}\n\n"
-                            else:
-                                # Accumulate arguments
-                                current_args = tool_calls_buffer[index].function.arguments
-                                new_args_chunk = tool_call.function.arguments
-
-                                # Ensure both parts are treated as strings (empty if None) before concatenation
-                                current_args_str = current_args if current_args is not None else ""
-                                new_args_chunk_str = new_args_chunk if new_args_chunk is not None else ""
-                                
-                                # Perform safe concatenation
-                                tool_calls_buffer[index].function.arguments = current_args_str + new_args_chunk_str
+                                while len(tool_calls_buffer) <= index:
+                                    tool_calls_buffer.append(None)
                             
-                            # If we have complete arguments, execute the function
-                            if (tool_call.function and tool_call.function.arguments and 
-                                tool_call.function.arguments.endswith("}")):
+                                if tool_calls_buffer[index] is None:
+                                    tool_calls_buffer[index] = _StreamedToolCall(
+                                        tool_call.id,
+                                        function.name if function else None
+                                    )
+                                    # First chunk of a tool call - we'll wait for full arguments before notifying
+                                    if function and function.name:
+                                        yield _tool_call_start(function.name, tool_call.id)
+                            
+                                # Accumulate arguments; execute the function once the JSON object is closed
                                 complete_tool_call = tool_calls_buffer[index]
-
-                                tool_name = complete_tool_call.function.name
+                                if function and function.arguments and complete_tool_call.feed(function.arguments):
+                                    tool_name = complete_tool_call.name
                                 
-                                try:
-                                    tool_input = json.loads(complete_tool_call.function.arguments)
-                                    yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': tool_name, 'input': tool_input})}\n\n"
+                                    try:
+                                        tool_input = orjson.loads(complete_tool_call.arguments)
                                     
-                                    # Execute the tool
-                                    tool_result = None
-                                    async for status in handle_tool_call(tool_name, tool_input, mcp_manager):
-                                        if status["type"] == "tool_execution_complete":
-                                            tool_result = status["result"]
-                                        else:
-                                            # Forward status updates to frontend
-                                            yield f"data: {json.dumps(status)}\n\n"
-
-                                    if tool_result and openai_client:
-                                        # Create a message with the tool call
-                                        tool_use_message = {
-                                            "role": "assistant",
-                                            "content": None,
-                                            "tool_calls": [
-                                                {
-                                                    "id": complete_tool_call.id,
-                                                    "type": "function",
-                                                    "function": {
-                                                        "name": tool_name,
-                                                        "arguments": complete_tool_call.function.arguments
+                                        # Execute the tool; its tool_execution status carries the parsed input to the frontend
+                                        tool_result = None
+                                        async for status in handle_tool_call(tool_name, tool_input, mcp_manager):
+                                            if status["type"] == "tool_execution_complete":
+                                                tool_result = status["result"]
+                                            else:
+                                                # Forward status updates to frontend
+                                                yield _sse(status)
+
+                                        if tool_result and openai_client:
+                                            # Create a message with the tool call
+                                            tool_use_message = {
+                                                "role": "assistant",
+                                                "content": None,
+                                                "tool_calls": [
+                                                    {
+                                                        "id": complete_tool_call.id,
+                                                        "type": "function",
+                                                        "function": {
+                                                            "name": tool_name,
+                                                            "arguments": complete_tool_call.arguments.decode()
+                                                        }
                                                     }
-                                                }
-                                            ]
-                                        }
+                                                ]
+                                            }
 
-                                        tool_result_text = ""
-                                        tool_result_image = ""
-                                        for result in json.loads(tool_result):
-                                            if result["type"] == "text":
-                                                tool_result_text = result
-                                            elif result["type"] == "image":
-                                                tool_result_image = f"data:{result['source']['media_type']};base64,{result['source']['data']}"
+                                            tool_result_text = ""
+                                            tool_result_image = ""
+                                            for result in tool_result:
+                                                if result["type"] == "text":
+                                                    tool_result_text = result
+                                                elif result["type"] == "image":
+                                                    tool_result_image = f"data:{result['source']['media_type']};base64,{result['source']['data']}"
                                         
-                                        if not tool_result_text:
-                                            tool_result_text = "This tool did not return any text."
+                                            if not tool_result_text:
+                                                tool_result_text = "This tool did not return any text."
                                         
-                                        # Create a message with the tool result
-                                        tool_result_message = {
-                                            "role": "tool",
-                                            "tool_call_id": complete_tool_call.id,
-                                            "name": tool_name,
-                                            "content": [tool_result_text]
-                                        }
-                                        
-                                        # Add messages to the running messages list
-                                        running_args["messages"].append(tool_use_message)
-                                        running_args["messages"].append(tool_result_message)
-
-                                        if tool_result_image and multimodal:
-                                            running_args["messages"].append({
-                                                "role": "user",
+                                            # Create a message with the tool result
+                                            tool_result_message = {
+                                                "role": "tool",
+                                                "tool_call_id": complete_tool_call.id,
                                                 "name": tool_name,
-                                                "content": [
-                                                    {
-                                                        "type": "image_url",
-                                                        "image_url": {
-                                                            "url": tool_result_image
+                                                "content": [tool_result_text]
+                                            }
+                                        
+                                            # Add messages to the running messages list
+                                            running_args["messages"].append(tool_use_message)
+                                            running_args["messages"].append(tool_result_message)
+
+                                            if tool_result_image and multimodal:
+                                                running_args["messages"].append({
+                                                    "role": "user",
+                                                    "name": tool_name,
+                                                    "content": [
+                                                        {
+                                                            "type": "image_url",
+                                                            "image_url": {
+                                                                "url": tool_result_image
+                                                            }
                                                         }
-                                                    }
-                                                ]
-                                            })
+                                                    ]
+                                                })
 
-                                        # Make sure tools are included in the next request
-                                        if tool_calls_count > 0 and "tools" in running_args:
-                                            running_args["tools"] = get_tool_definitions(canonical_tools=enabled_tools)
-                                            running_args["tool_choice"] = "auto"
+                                            # The tool definitions are already in running_args; only relax tool_choice
+                                            if tool_calls_count > 0 and "tools" in running_args:
+                                                running_args["tool_choice"] = "auto"
                                         
-                                        tool_calls_count += 1
-                                        tool_calls_buffer = {}  # Reset buffer for next iteration
+                                            if tool_calls_count >= MAX_TOOL_TURNS:
+                                                raise Exception(f"Tool call limit reached ({MAX_TOOL_TURNS} turns)")
+                                            tool_calls_count += 1
+                                            tool_calls_buffer.clear()  # Reset buffer for next iteration
                                         
-                                        # Get new response incorporating tool results
-                                        response = await openai_client.chat.completions.create(**running_args)
+                                            # Release this stream once the read-ahead has stopped; the next iteration requests a new one
+                                            release_stream = True
                                         
-                                        # Set flag to continue processing with the new response
-                                        should_continue = True
+                                            # Set flag to continue processing with the new response
+                                            should_continue = True
                                         
-                                        # Break the inner loop to start processing the new response
-                                        break
+                                            # Break the inner loop to start processing the new response
+                                            break
                                         
-                                except json.JSONDecodeError:
-                                    log_error(f"Failed to parse tool input JSON: {complete_tool_call.function.arguments}")
-                                    yield f"data: {json.dumps({'type': 'tool_call_end', 'tool': tool_name, 'input': {}})}\n\n"
+                                    except json.JSONDecodeError:
+                                        log_error(f"Failed to parse tool input JSON: {complete_tool_call.arguments.decode(errors='replace')}")
+                                        yield _tool_call_end(tool_name, {})
                     
 
-                # Check finish reason
-                if chunk.choices and chunk.choices[0].finish_reason:
+                    # Check finish reason
+                    if finish:
                     
-                    if chunk.usage:
-                        usage = await parse_usage(chunk.usage)
-                        log_info("Token usage in OpenAI", usage)
-                        yield f"data: {json.dumps(usage)}\n\n"
-
-                    if chunk.choices[0].finish_reason == 'stop' and text_generated:
-                        log_info("Stream generator ended normally")
-                        break
-                    elif chunk.choices[0].finish_reason == 'stop' and not text_generated:
-                        log_info("Stream generator ended but no text generated")
-                        break
-                    elif chunk.choices[0].finish_reason == 'tool_calls':
-                        log_info("Tool call completed, continuing with new request")
-                        should_continue = True  # Ensure we continue processing for tool calls
+                        if chunk.usage:
+                            usage = parse_usage(chunk.usage)
+                            log_info("Token usage in OpenAI", usage)
+                            yield _sse(usage)
+
+                        if finish == 'stop' and text_generated:
+                            log_info("Stream generator ended normally")
+                            break
+                        elif finish == 'stop' and not text_generated:
+                            log_info("Stream generator ended but no text generated")
+                            break
+                        elif finish == 'tool_calls':
+                            log_info("Tool call completed, continuing with new request")
+                            should_continue = True  # Ensure we continue processing for tool calls
+                            break
+
+                    # If we need to continue with a new response due to tool call,
+                    # break the inner loop early
+                    if should_continue:
                         break
 
-                # If we need to continue with a new response due to tool call,
-                # break the inner loop early
-                if should_continue:
-                    break
+            if release_stream:
+                await stream.close()
+                stream = None
 
             # If we've completed processing and there are no more tool calls to handle
             if not should_continue:
-                yield 'data: {"text": "[DONE]"}\n\n'
+                yield _DONE
                 break
 
     except Exception as e:
         log_error(f"Error in OpenAI stream generator: {str(e)}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield _sse({'error': str(e)})
 
 
+@_coalesced
 async def anthropic_stream_generator(
     response, 
     anthropic_client: AsyncAnthropic, 
@@ -455,7 +843,7 @@ async def anthropic_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generate streaming response for Anthropic API.
     Handles both regular text responses and tool use cases with recursive tool handling.
@@ -470,88 +858,76 @@ async def anthropic_stream_generator(
         Streaming response data in SSE format
     """
     try:
+        text_frame = _text_frame  # Local alias for the per-chunk text path
         usage = {}
-        tool_input_json = ""
-        partial_text = ""
+        tool_input_parts = []
+        partial_text_parts = []
         current_tool_name = None
         current_tool_id = None
+        pending_tool_uses = []  # tool_use blocks of the current assistant turn
         should_continue = True
         tool_calls_count = 0
-        # Create running params that will be updated with each tool call
-        running_params = params.copy()
+        # Create running params that will be updated with each tool call; only the messages list is copied
+        running_params = {**params, "messages": list(params["messages"])}
+        # Resolve the follow-up create call once; Claude 3.7 uses the token-efficient tools beta
+        create_message = None
+        if anthropic_client:
+            if "claude-3-7" in running_params["model"]:
+                running_params["betas"] = ["token-efficient-tools-2025-02-19"]
+                create_message = anthropic_client.beta.messages.create
+            else:
+                create_message = anthropic_client.messages.create
 
         while should_continue:
             should_continue = False  # Will be set to True if we need another iteration for tool execution
             log_info("Processing Anthropic stream")
             
-            async for event in response:
-                if event.type == "message_start":
-                    message = event.message
-                    if hasattr(message, 'usage'):
-                        usage_start = await parse_usage_anthropic(message.usage)
-                        log_info("Token usage in Anthropic in message_start", usage_start)
-                        usage.update(usage_start)
+            async with aclosing(_read_ahead(response)) as events:
+                async for event in events:
+                    # Dispatch on the event type once, most frequent events first
+                    event_type = event.type
+                    if event_type == "content_block_delta":
+                        delta = event.delta
+                        delta_type = delta.type
+                        if delta_type == "text_delta":
+                            delta_text = delta.text
+                            yield text_frame(delta_text)
+                            partial_text_parts.append(delta_text)
+                        elif delta_type == "input_json_delta":
+                            # Accumulate the tool input JSON
+                            tool_input_parts.append(delta.partial_json)
+                        elif delta_type == "thinking_delta":
+                            log_debug(delta.thinking)
                         
-                elif event.type == "content_block_start":
-                    if hasattr(event, 'content_block') and event.content_block:
-                        if event.content_block.type == "thinking":
-                            print(f"思考：{event.content_block.thinking}", end="", flush=True)
-                        elif event.content_block.type == "text":
-                            yield f"data: {json.dumps({'text': event.content_block.text})}\n\n"
-                            partial_text += event.content_block.text
-                        elif event.content_block.type == "tool_use":
-                            # Tool use started - send tool call start event
-                            current_tool_name = event.content_block.name
-                            current_tool_id = event.content_block.id
-                            tool_input_json = ""  # Reset the tool input JSON
-                        
-                elif event.type == "content_block_delta":
-                    if event.delta.type == "thinking_delta":
-                        print(f"{event.delta.thinking}", end="", flush=True)
-                    elif event.delta.type == "text_delta":
-                        yield f"data: {json.dumps({'text': event.delta.text})}\n\n"
-                        partial_text += event.delta.text
-                    elif event.delta.type == "input_json_delta":
-                        # Accumulate the tool input JSON
-                        tool_input_json += event.delta.partial_json
+                    elif event_type == "ping":
+                        yield _PING
+                    
+                    elif event_type == "content_block_start":
+                        content_block = getattr(event, 'content_block', None)
+                        if content_block:
+                            block_type = content_block.type
+                            if block_type == "thinking":
+                                log_debug(f"思考：{content_block.thinking}")
+                            elif block_type == "text":
+                                yield text_frame(content_block.text)
+                                partial_text_parts.append(content_block.text)
+                            elif block_type == "tool_use":
+                                # Tool use started - send tool call start event
+                                current_tool_name = content_block.name
+                                current_tool_id = content_block.id
+                                tool_input_parts.clear()  # Reset the tool input JSON
                         
-                elif event.type == "content_block_stop":
-                    if current_tool_name and current_tool_id:
-                        # Tool use completed - try to parse the JSON and handle the tool call
-                        try:
-                            tool_input = json.loads(tool_input_json) if tool_input_json else {}
+                    elif event_type == "content_block_stop":
+                        if current_tool_name and current_tool_id:
+                            # Tool use completed - parse the JSON and queue the tool call for this turn
+                            tool_input_json = "".join(tool_input_parts)
+                            try:
+                                tool_input = orjson.loads(tool_input_json) if tool_input_json else {}
                             
-                            # Execute the tool if we have a client to send results back to
-                            if anthropic_client and current_tool_id and running_params is not None:
-                                yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': current_tool_name, 'id': current_tool_id})}\n\n"
-                                log_info("Executing tool", {
-                                    "tool": current_tool_name,
-                                    "tool_use_id": current_tool_id
-                                })
-                                # Process the tool call
-                                tool_result = None
-                                async for status in handle_tool_call(current_tool_name, tool_input, mcp_manager):
-                                    if status["type"] == "tool_execution_complete":
-                                        tool_result = status["result"]
-                                    else:
-                                        # Forward status updates to frontend
-                                        yield f"data: {json.dumps(status)}\n\n"
-                                
-                                if tool_result:
-                                    # Use the running parameters which contain the full conversation context
-                                    tool_use_content = []
-
-                                    # if partial_text is not none, add text block to tool_use_content
-                                    if partial_text:
-                                        tool_use_content.append(
-                                            {
-                                                "type": "text",
-                                                "text": partial_text
-                                            }
-                                        )
-
-                                    # add tool_use block to tool_use_content
-                                    tool_use_content.append(
+                                # Execute the tool if we have a client to send results back to
+                                if create_message is not None:
+                                    yield _tool_call_start(current_tool_name, current_tool_id)
+                                    pending_tool_uses.append(
                                         {
                                             "type": "tool_use",
                                             "id": current_tool_id,
@@ -559,106 +935,137 @@ async def anthropic_stream_generator(
                                             "input": tool_input
                                         }
                                     )
-
-                                    tool_use_message = {
-                                        "role": "assistant",
-                                        "content": tool_use_content
-                                    }
-
-                                    # Create a user message with the tool result
-                                    tool_result_message = {
-                                        "role": "user",
-                                        "content": [
-                                            {
-                                                "type": "tool_result",
-                                                "tool_use_id": current_tool_id,
-                                                "content": json.loads(tool_result)
-                                            }
-                                        ]
-                                    }
-                                    
-                                    # Add messages to the running parameters
-                                    running_params["messages"].append(tool_use_message)
-                                    running_params["messages"].append(tool_result_message)
-                                    
-                                    # Make sure tools are included in the next request
-                                    if tool_calls_count > 0 and "tools" in running_params:
-                                        running_params["tools"] = get_anthropic_tool_definitions(canonical_tools=enabled_tools)
-                                        
-                                    log_info("Submitting tool result for continuation", {
-                                        "tool": current_tool_name,
-                                        "tool_use_id": current_tool_id
-                                    })
-
-                                    # log_info("Running Messages", running_params["messages"])
-
-                                    # Create a new response with the tool result
-                                    if "claude-3-7" in running_params["model"]:
-                                        running_params["betas"] = ["token-efficient-tools-2025-02-19"]
-                                        response = await anthropic_client.beta.messages.create(**running_params)
-                                    else:
-                                        response = await anthropic_client.messages.create(**running_params)
-                                    
-                                    # Set flag to continue processing with the new response
-                                    should_continue = True
-                                    tool_calls_count += 1
-                                    
-                                    # Reset tracking variables for next iteration
-                                    current_tool_name = None
-                                    current_tool_id = None
-
-                                    if partial_text:
-                                        # send line break to frontend
-                                        yield f"data: {json.dumps({'text': '\n\n'})}\n\n"
-
-                                    partial_text = ""
-
-                                    # Break the inner loop to start processing the new response
-                                    break
                             
-                        except json.JSONDecodeError:
-                            log_error(f"Failed to parse tool input JSON: {tool_input_json}")
-                            yield f"data: {json.dumps({'type': 'tool_call_end', 'tool': current_tool_name, 'input': {}})}\n\n"
+                            except json.JSONDecodeError:
+                                log_error(f"Failed to parse tool input JSON: {tool_input_json}")
+                                yield _tool_call_end(current_tool_name, {})
                         
-                        # Reset tool tracking variables if not continuing
-                        if not should_continue:
+                            # Reset tool tracking variables for the next content block
                             current_tool_name = None
                             current_tool_id = None
                         
-                elif event.type == "message_delta":
-                    if hasattr(event, 'usage'):
-                        usage_delta = await parse_usage_anthropic(event.usage)
-                        log_info("Token usage in Anthropic in message_delta", usage_delta)
-                        usage.update(usage_delta)
-                        yield f"data: {json.dumps(usage)}\n\n"
+                    elif event_type == "message_delta":
+                        delta_usage = getattr(event, 'usage', None)
+                        if delta_usage is not None:
+                            # Emitted once at message_stop
+                            usage.update(parse_usage_anthropic(delta_usage))
                         
-                    # Forward stop reason to client
-                    if hasattr(event, 'delta') and hasattr(event.delta, 'stop_reason'):
-                        # stop_reason is not "tool_use" means the response is finished
-                        if event.delta.stop_reason != "tool_use":
-                            yield f"data: {json.dumps({'stop_reason': event.delta.stop_reason})}\n\n"
-                        elif event.delta.stop_reason == "tool_use":
-                            # in tool use, continue the loop
-                            log_info("Tool use continues")
-                            should_continue = True
+                        # Forward stop reason to client
+                        stop_reason = getattr(getattr(event, 'delta', None), 'stop_reason', None)
+                        if stop_reason is not None:
+                            # stop_reason is not "tool_use" means the response is finished
+                            if stop_reason != "tool_use":
+                                yield _sse({'stop_reason': stop_reason})
+                            else:
+                                # in tool use, continue the loop
+                                log_info("Tool use continues")
+                                should_continue = True
                         
-                elif event.type == "message_stop":
-                    if not should_continue:  # Only emit DONE if we're not continuing with a tool result
-                        yield f"data: {json.dumps({'text': '[DONE]'})}\n\n"
+                    elif event_type == "message_start":
+                        message_usage = getattr(event.message, 'usage', None)
+                        if message_usage is not None:
+                            # Emitted together with the message_delta usage at message_stop
+                            usage.update(parse_usage_anthropic(message_usage))
                         
-                elif event.type == "ping":
-                    yield ": ping\n\n"
-                    
-                elif event.type == "error":
-                    raise Exception(event.error.message)
+                    elif event_type == "message_stop":
+                        if usage:
+                            log_info("Token usage in Anthropic", usage)
+                            yield _sse(usage)
+                        if not should_continue:  # Only emit DONE if we're not continuing with a tool result
+                            yield _DONE
+                        
+                    elif event_type == "error":
+                        raise Exception(event.error.message)
             
+            # Execute every tool use of this assistant turn and submit all results in one request
+            should_continue = False
+            if pending_tool_uses:
+                for tool_use in pending_tool_uses:
+                    log_info("Executing tool", {
+                        "tool": tool_use["name"],
+                        "tool_use_id": tool_use["id"]
+                    })
+                tool_results = [None] * len(pending_tool_uses)
+                async with aclosing(_run_tool_calls(
+                    [(tool_use["name"], tool_use["input"]) for tool_use in pending_tool_uses],
+                    mcp_manager
+                )) as tool_statuses:
+                    async for index, status in tool_statuses:
+                        if status["type"] == "tool_execution_complete":
+                            tool_results[index] = status["result"]
+                        else:
+                            # Forward status updates to frontend
+                            yield _sse(status)
+
+                if all(tool_results):
+                    # Use the running parameters which contain the full conversation context
+                    tool_use_content = []
+
+                    # if partial_text is not none, add text block to tool_use_content
+                    partial_text = "".join(partial_text_parts)
+                    if partial_text:
+                        tool_use_content.append(
+                            {
+                                "type": "text",
+                                "text": partial_text
+                            }
+                        )
+
+                    # add all tool_use blocks to tool_use_content
+                    tool_use_content.extend(pending_tool_uses)
+
+                    tool_use_message = {
+                        "role": "assistant",
+                        "content": tool_use_content
+                    }
+
+                    # Create a single user message with every tool result
+                    tool_result_message = {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "tool_result",
+                                "tool_use_id": tool_use["id"],
+                                "content": tool_result
+                            }
+                            for tool_use, tool_result in zip(pending_tool_uses, tool_results)
+                        ]
+                    }
+                    
+                    # Add messages to the running parameters
+                    running_params["messages"].append(tool_use_message)
+                    running_params["messages"].append(tool_result_message)
+                    
+                    log_info("Submitting tool results for continuation", {
+                        "tool_use_ids": [tool_use["id"] for tool_use in pending_tool_uses]
+                    })
+
+                    if tool_calls_count >= MAX_TOOL_TURNS:
+                        raise Exception(f"Tool call limit reached ({MAX_TOOL_TURNS} turns)")
+
+                    # Create a new response with the tool results
+                    async with _TOOL_TURN_SEMAPHORE:
+                        response = await create_message(**running_params)
+                    
+                    # Set flag to continue processing with the new response
+                    should_continue = True
+                    tool_calls_count += 1
+
+                    if partial_text:
+                        # send line break to frontend
+                        yield text_frame('\n\n')
+
+                    partial_text_parts.clear()
+
+                pending_tool_uses = []
+
             # If we're not continuing due to a tool call, break the outer loop
             if not should_continue:
                 break
                 
     except Exception as e:
         log_error(f"Error in Anthropic stream generator: {str(e)}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n" 
+        yield _sse({'error': str(e)}) 
 
 async def anthropic_non_stream_generator(
     response, 
@@ -668,7 +1075,7 @@ async def anthropic_non_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generate non-streaming response for Anthropic API.
     Handles both regular text responses and tool use cases.
@@ -684,105 +1091,117 @@ async def anthropic_non_stream_generator(
     """
     try:
         content = response.content
-        running_params = params.copy() if params else None
+        running_params = {**params, "messages": list(params.get("messages", []))} if params else None
         
-        # Check if there's a tool use in the response
-        has_tool_use = False
+        # Split the response into text and tool uses in a single pass
+        text_parts = []
+        tool_use_blocks = []
         for block in content:
-            if block.type == "tool_use":
-                has_tool_use = True
-                
-                # Send the tool use start event
-                yield f'data: {json.dumps({"type": "tool_call_start", "tool": block.name, "id": block.id})}\n\n'
-                
-                # Parse the tool input
-                try:
-                    tool_input = json.loads(block.input) if block.input else {}
-                    yield f'data: {json.dumps({"type": "tool_call_end", "tool": block.name, "input": tool_input})}\n\n'
-                    
-                    # Execute the tool
-                    tool_result = None
-                    async for status in handle_tool_call(block.name, tool_input, mcp_manager):
-                        yield f'data: {json.dumps(status)}\n\n'
+            if block.type == "text":
+                text_parts.append(block.text)
+            elif block.type == "tool_use":
+                tool_use_blocks.append(block)
+        has_tool_use = bool(tool_use_blocks)
+        if has_tool_use:
+            try:
+                tool_inputs = []
+                for block in tool_use_blocks:
+                    # Send the tool use start event
+                    yield _tool_call_start(block.name, block.id)
+
+                    # The SDK already decodes the tool input; parse it only if it arrives as raw JSON
+                    tool_input = block.input or {}
+                    if isinstance(tool_input, (str, bytes)):
+                        tool_input = orjson.loads(tool_input)
+                    tool_inputs.append(tool_input)
+                    yield _tool_call_end(block.name, tool_input)
+
+                # Execute all tools of this response concurrently
+                tool_results = [None] * len(tool_use_blocks)
+                async with aclosing(_run_tool_calls(
+                    [(block.name, tool_input) for block, tool_input in zip(tool_use_blocks, tool_inputs)],
+                    mcp_manager
+                )) as tool_statuses:
+                    async for index, status in tool_statuses:
                         if status["type"] == "tool_execution_complete":
-                            tool_result = status["result"]
-                    
-                    if tool_result and anthropic_client and running_params:
-                        # Get text content from the response to preserve in tool use message
-                        text_content = ""
-                        for text_block in content:
-                            if text_block.type == "text":
-                                text_content += text_block.text
-                        
-                        # Create assistant message with tool use
-                        tool_use_message = {
-                            "role": "assistant",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": text_content
-                                },
-                                {
-                                    "type": "tool_use",
-                                    "id": block.id,
-                                    "name": block.name,
-                                    "input": tool_input
-                                }
-                            ]
-                        }
-                        
-                        # Create user message with tool result
-                        tool_result_message = {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "tool_result",
-                                    "tool_use_id": block.id,
-                                    "content": tool_result
-                                }
-                            ]
-                        }
-                        
-                        # Add messages to running params
-                        if "messages" in running_params:
-                            running_params["messages"].append(tool_use_message)
-                            running_params["messages"].append(tool_result_message)
+                            tool_results[index] = status["result"]
                         else:
-                            running_params["messages"] = [tool_use_message, tool_result_message]
-                        
-                        # Continue the conversation with the tool result
+                            # Forward status updates to frontend
+                            yield _sse(status)
+
+                if all(tool_results) and anthropic_client and running_params:
+                    # Text content from the response to preserve in tool use message
+                    text_content = "".join(text_parts)
+
+                    # Create assistant message with all tool uses
+                    tool_use_message = {
+                        "role": "assistant",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": text_content
+                            }
+                        ] + [
+                            {
+                                "type": "tool_use",
+                                "id": block.id,
+                                "name": block.name,
+                                "input": tool_input
+                            }
+                            for block, tool_input in zip(tool_use_blocks, tool_inputs)
+                        ]
+                    }
+
+                    # Create a single user message with every tool result
+                    tool_result_message = {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "tool_result",
+                                "tool_use_id": block.id,
+                                "content": tool_result
+                            }
+                            for block, tool_result in zip(tool_use_blocks, tool_results)
+                        ]
+                    }
+
+                    # Add messages to running params
+                    running_params["messages"].append(tool_use_message)
+                    running_params["messages"].append(tool_result_message)
+
+                    # Continue the conversation with all tool results in one request
+                    async with _TOOL_TURN_SEMAPHORE:
                         tool_response = await anthropic_client.messages.create(**running_params)
-                        
-                        # Process the response content
-                        for tool_block in tool_response.content:
-                            if tool_block.type == "text":
-                                yield f'data: {json.dumps({"text": tool_block.text})}\n\n'
-                
-                except Exception as e:
-                    log_error(f"Error handling tool use: {str(e)}")
-                    yield f'data: {json.dumps({"error": str(e)})}\n\n'
-                
-                break  # Only handle the first tool use in non-streaming mode
-        
+
+                    # Process the response content
+                    for tool_block in tool_response.content:
+                        if tool_block.type == "text":
+                            yield _sse({"text": tool_block.text})
+
+            except Exception as e:
+                log_error(f"Error handling tool use: {str(e)}")
+                yield _sse({"error": str(e)})
+
         # If no tool use, just return the text content
         if not has_tool_use:
             for block in content:
                 if block.type == "text":
-                    yield f'data: {json.dumps({"text": block.text})}\n\n'
+                    yield _sse({"text": block.text})
                 elif block.type == "thinking":
                     if block.thinking:
-                        print(f"思考：{block.thinking}")
+                        log_debug(f"思考：{block.thinking}")
 
         # Include usage information if available
-        if hasattr(response, 'usage'):
-            usage = await parse_usage_anthropic(response.usage)
-            yield f"data: {json.dumps(usage)}\n\n"
+        response_usage = getattr(response, 'usage', None)
+        if response_usage is not None:
+            usage = parse_usage_anthropic(response_usage)
+            yield _sse(usage)
 
-        yield 'data: {"text": "[DONE]"}\n\n'
+        yield _DONE
         
     except Exception as e:
         log_error(f"Error in Anthropic non-stream generator: {str(e)}")
-        yield f'data: {json.dumps({"error": str(e)})}\n\n' 
+        yield _sse({"error": str(e)}) 
 
 
 async def gemini_non_stream_generator(
@@ -795,7 +1214,7 @@ async def gemini_non_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generate non-streaming response for Gemini API.
     Handles both regular text responses and function calls.
@@ -811,78 +1230,84 @@ async def gemini_non_stream_generator(
         Response data in SSE format
     """
     try:
-        # Make a copy of history and completion_args to maintain context
-        running_history = history.copy()
-        running_args = completion_args.copy()
-        
         # Handle function calls if present
-        if hasattr(response, 'function_calls'):
-            for function_call in response.function_calls:
-                # Notify about tool call start
-                yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': function_call.name})}\n\n"
-                
-                # Handle the tool call
-                tool_result = None
-                async for status in handle_tool_call(function_call.name, function_call.args, mcp_manager):
+        function_calls = getattr(response, 'function_calls', None)
+        if function_calls:
+            # Notify about tool call start
+            for function_call in function_calls:
+                yield _tool_call_start(function_call.name)
+
+            # Handle all tool calls of this response concurrently
+            tool_results = [None] * len(function_calls)
+            async with aclosing(_run_tool_calls(
+                [(function_call.name, function_call.args) for function_call in function_calls],
+                mcp_manager
+            )) as tool_statuses:
+                async for index, status in tool_statuses:
                     if status["type"] == "tool_execution_complete":
-                        tool_result = status["result"]
+                        tool_results[index] = status["result"]
                     else:
                         # Forward status updates to frontend
-                        yield f"data: {json.dumps(status)}\n\n"
-                
-                # Create function call content
-                function_call_part = Part.from_function_call(
-                    name=function_call.name,
-                    args=function_call.args
-                )
-                function_call_content = Content(
-                    role="model",
-                    parts=[function_call_part]
-                )
-                running_history.append(function_call_content)
-                
-                # Create function response content with the tool result
-                function_response_part = Part.from_function_response(
-                    name=function_call.name,
-                    response={"result": tool_result}
-                )
-                function_response_content = Content(
-                    role="user", 
-                    parts=[function_response_part]
-                )
-                running_history.append(function_response_content)
-                
-                # Change tool config to AUTO
-                tool_config = ToolConfig(
-                    function_calling_config=FunctionCallingConfig(mode='AUTO')
-                )
-                running_args["tool_config"] = tool_config
-
-                # Create new chat with updated history
-                chat = gemini_client.aio.chats.create(
-                    history=running_history,
-                    model=model,
-                    config=GenerateContentConfig(**running_args)
-                )
-                
-                # Get final response incorporating tool results
+                        yield _sse(status)
+
+            # Create function call content
+            function_call_content = Content(
+                role="model",
+                parts=[
+                    Part.from_function_call(
+                        name=function_call.name,
+                        args=function_call.args
+                    )
+                    for function_call in function_calls
+                ]
+            )
+            running_history = list(history)
+            running_args = completion_args.copy()
+            running_history.append(function_call_content)
+
+            # Create function response content with all tool results
+            function_response_content = Content(
+                role="user",
+                parts=[
+                    Part.from_function_response(
+                        name=function_call.name,
+                        response={"result": json.dumps(tool_result)}
+                    )
+                    for function_call, tool_result in zip(function_calls, tool_results)
+                ]
+            )
+            running_history.append(function_response_content)
+
+            # Change tool config to AUTO
+            running_args["tool_config"] = _AUTO_TOOL_CONFIG
+
+            # Create new chat with updated history
+            chat = gemini_client.aio.chats.create(
+                history=running_history,
+                model=model,
+                config=GenerateContentConfig(**running_args)
+            )
+
+            # Get final response incorporating all tool results in one request
+            async with _TOOL_TURN_SEMAPHORE:
                 response = await chat.send_message(function_response_content)
 
         # Output the final text response
-        if hasattr(response, 'text'):
-            yield f'data: {json.dumps({"text": response.text})}\n\n'
+        response_text = getattr(response, 'text', None)
+        if response_text is not None:
+            yield _sse({"text": response_text})
 
         # Handle usage metadata if present
         if response.usage_metadata:
-            usage = await parse_usage_gemini(response.usage_metadata)
+            usage = parse_usage_gemini(response.usage_metadata)
             log_info("Token usage in Gemini", usage)
-            yield f"data: {json.dumps(usage)}\n\n"
+            yield _sse(usage)
 
-        yield 'data: {"text": "[DONE]"}\n\n'
+        yield _DONE
 
     except Exception as e:
         log_error(f"Error in Gemini non-stream generator: {str(e)}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield _sse({'error': str(e)})
 
 
 async def openai_non_stream_generator(
@@ -892,7 +1317,7 @@ async def openai_non_stream_generator(
     mcp_manager: PolyMCPClient,
     enabled_tools: list[CanonicalToolDefinition],
     multimodal: bool = False
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Common processing for non-streaming OpenAI API calls.
     This function also handles tool_calls if present in the response.
@@ -907,94 +1332,98 @@ async def openai_non_stream_generator(
         A StreamingResponse containing the response message.
     """
     try:
-        # Create a running copy of completion args to maintain context
-        running_args = completion_args.copy()
+        # Copy the args and the message list we append to; the caller's messages stay untouched
+        running_args = {**completion_args, "messages": list(completion_args["messages"])}
         
         response = await openai_client.chat.completions.create(**running_args)
         
         # Check if tool calls are present in the response
-        if response.choices[0].message.tool_calls:
-            for tool_call in response.choices[0].message.tool_calls:
-                yield f"data: {json.dumps({'type': 'tool_call_start', 'tool': tool_call.function.name, 'id': tool_call.id})}\n\n"
-                
-                # Parse the tool input
-                try:
-                    tool_input = json.loads(tool_call.function.arguments)
-                    yield f"data: {json.dumps({'type': 'tool_call_end', 'tool': tool_call.function.name, 'input': tool_input})}\n\n"
-                    
-                    # Execute the tool
-                    tool_result = None
-                    async for status in handle_tool_call(tool_call.function.name, tool_input, mcp_manager):
-                        yield f"data: {json.dumps(status)}\n\n"
+        tool_calls = response.choices[0].message.tool_calls
+        if tool_calls:
+            # Parse the tool inputs
+            try:
+                tool_inputs = []
+                for tool_call in tool_calls:
+                    yield _tool_call_start(tool_call.function.name, tool_call.id)
+                    tool_input = orjson.loads(tool_call.function.arguments)
+                    tool_inputs.append(tool_input)
+                    yield _tool_call_end(tool_call.function.name, tool_input)
+
+                # Execute all tools of this response concurrently
+                tool_results = [None] * len(tool_calls)
+                async with aclosing(_run_tool_calls(
+                    [(tool_call.function.name, tool_input) for tool_call, tool_input in zip(tool_calls, tool_inputs)],
+                    mcp_manager
+                )) as tool_statuses:
+                    async for index, status in tool_statuses:
                         if status["type"] == "tool_execution_complete":
-                            tool_result = status["result"]
-                    
-                    if tool_result:
-                        # Create a message with the tool call
-                        tool_use_message = {
-                            "role": "assistant",
-                            "content": None,
-                            "tool_calls": [
-                                {
-                                    "id": tool_call.id,
-                                    "type": "function",
-                                    "function": {
-                                        "name": tool_call.function.name,
-                                        "arguments": tool_call.function.arguments
-                                    }
+                            tool_results[index] = status["result"]
+                        else:
+                            # Forward status updates to frontend
+                            yield _sse(status)
+
+                if all(tool_results):
+                    # Create a message with all tool calls
+                    tool_use_message = {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": [
+                            {
+                                "id": tool_call.id,
+                                "type": "function",
+                                "function": {
+                                    "name": tool_call.function.name,
+                                    "arguments": tool_call.function.arguments
                                 }
-                            ]
-                        }
-                        
-                        # Create a message with the tool result
-                        tool_result_message = {
+                            }
+                            for tool_call in tool_calls
+                        ]
+                    }
+
+                    # Add the assistant message and one result message per tool call
+                    running_args["messages"].append(tool_use_message)
+                    for tool_call, tool_result in zip(tool_calls, tool_results):
+                        running_args["messages"].append({
                             "role": "tool",
                             "tool_call_id": tool_call.id,
                             "name": tool_call.function.name,
-                            "content": tool_result
-                        }
-                        
-                        # Add messages to the running messages
-                        running_args["messages"].append(tool_use_message)
-                        running_args["messages"].append(tool_result_message)    
-                        
-                        # Make sure tools are included in the next request
-                        running_args["tools"] = get_tool_definitions(canonical_tools=enabled_tools)
-                        running_args["tool_choice"] = "auto"
-                        
-                        # Continue the conversation with the tool result
+                            "content": json.dumps(tool_result)
+                        })
+
+                    # The tool definitions are already in running_args; only relax tool_choice
+                    running_args["tool_choice"] = "auto"
+
+                    # Continue the conversation with all tool results in one request
+                    async with _TOOL_TURN_SEMAPHORE:
                         next_response = await openai_client.chat.completions.create(**running_args)
-                        
-                        # Output the final text response
-                        if next_response.choices[0].message.content:
-                            yield f'data: {json.dumps({"text": next_response.choices[0].message.content})}\n\n'
-                            
-                        # Return usage info if available
-                        if next_response.usage:
-                            usage = await parse_usage(next_response.usage)
-                            log_info("Token usage in OpenAI", usage)
-                            yield f"data: {json.dumps(usage)}\n\n"
-                            
-                except json.JSONDecodeError as e:
-                    log_error(f"Failed to parse tool arguments: {str(e)}")
-                    yield f"data: {json.dumps({'error': f'Failed to parse tool arguments: {str(e)}'})}\n\n"
-                
-                # Only handle the first tool call in non-streaming mode
-                break
-        
+
+                    # Output the final text response
+                    if next_response.choices[0].message.content:
+                        yield _sse({"text": next_response.choices[0].message.content})
+
+                    # Return usage info if available
+                    if next_response.usage:
+                        usage = parse_usage(next_response.usage)
+                        log_info("Token usage in OpenAI", usage)
+                        yield _sse(usage)
+
+            except json.JSONDecodeError as e:
+                log_error(f"Failed to parse tool arguments: {str(e)}")
+                yield _sse({'error': f'Failed to parse tool arguments: {str(e)}'})
+
         # If no tool calls, just return the regular content
         elif response.choices[0].message.content:
-            yield f'data: {json.dumps({"text": response.choices[0].message.content})}\n\n'
+            yield _sse({"text": response.choices[0].message.content})
             
             # Return usage info if available
             if response.usage:
-                usage = await parse_usage(response.usage)
+                usage = parse_usage(response.usage)
                 log_info("Token usage in OpenAI", usage)
-                yield f"data: {json.dumps(usage)}\n\n"
+                yield _sse(usage)
         
-        yield 'data: {"text": "[DONE]"}\n\n'
+        yield _DONE
         
     except Exception as e:
         log_error(f"Error in OpenAI non-stream generator: {str(e)}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield _sse({'error': str(e)})
 
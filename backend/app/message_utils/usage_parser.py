@@ -1,6 +1,6 @@
 from typing import List, Dict, Any
 
-async def parse_usage(usage: Any) -> Dict[str, Any]:
+def parse_usage(usage: Any) -> Dict[str, Any]:
     """
     Parse usage information from OpenAI's response.
     This is a common utility used by both streaming and non-streaming responses.
@@ -28,7 +28,7 @@ async def parse_usage(usage: Any) -> Dict[str, Any]:
 
     return usage_info 
 
-async def parse_usage_anthropic(usage: Any) -> Dict[str, Any]:
+def parse_usage_anthropic(usage: Any) -> Dict[str, Any]:
     """
     Parse usage information from Anthropic's response.
     """
@@ -48,7 +48,7 @@ async def parse_usage_anthropic(usage: Any) -> Dict[str, Any]:
     }
     return usage_info
 
-async def parse_usage_gemini(usage: Any) -> Dict[str, Any]:
+def parse_usage_gemini(usage: Any) -> Dict[str, Any]:
     """
     Parse usage information from Gemini's response.
     """
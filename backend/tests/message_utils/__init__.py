@@ -0,0 +1 @@
+# Message utils tests package
\ No newline at end of file
@@ -0,0 +1,216 @@
+import sys
+import asyncio
+from contextlib import aclosing
+from pathlib import Path
+
+# Add the parent directory to the Python path to import app modules
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from app.message_utils import response_generator
+from app.message_utils.response_generator import (
+    _DONE,
+    _StreamedToolCall,
+    _coalesce,
+    _read_ahead,
+    _run_tool_calls,
+    _text_frame,
+    _tool_call_start,
+)
+
+
+async def _collect(generator):
+    return [item async for item in generator]
+
+
+def test_streamed_tool_call_fragmented_arguments():
+    """Completion is detected only when the top-level object closes, across any fragment split."""
+    arguments = '{"query": "a {b} \\"c}\\" \\\\", "options": {"depth": {"max": 2}}}'
+    for size in (1, 2, 3, 7):
+        tool_call = _StreamedToolCall("call_1", "web_search")
+        fragments = [arguments[i:i + size] for i in range(0, len(arguments), size)]
+        completed = [tool_call.feed(fragment) for fragment in fragments]
+        assert completed == [False] * (len(fragments) - 1) + [True]
+        assert tool_call.arguments.decode() == arguments
+
+
+def test_streamed_tool_call_non_ascii_arguments():
+    """Non-ASCII characters are accumulated as UTF-8 and do not affect brace tracking."""
+    arguments = '{"query": "東京の天気 {明日}", "lang": "ja"}'
+    tool_call = _StreamedToolCall("call_1", "web_search")
+    completed = [tool_call.feed(char) for char in arguments]
+    assert completed.index(True) == len(arguments) - 1
+    assert tool_call.arguments.decode("utf-8") == arguments
+
+
+def test_streamed_tool_call_without_arguments():
+    """A tool call without parameters completes on its empty object."""
+    tool_call = _StreamedToolCall("call_1", "get_time")
+    assert tool_call.feed("") is False
+    assert not tool_call.complete
+    assert tool_call.feed("{") is False
+    assert tool_call.feed("}") is True
+    assert tool_call.arguments == b"{}"
+
+    tool_call = _StreamedToolCall("call_2", "get_time")
+    assert tool_call.feed("{}") is True
+    assert tool_call.feed("") is False
+    assert tool_call.arguments == b"{}"
+
+
+def test_run_tool_calls_respects_parallel_limit(monkeypatch):
+    """No more than MAX_PARALLEL_TOOL_CALLS tools run at the same time."""
+    running = 0
+    peak = 0
+
+    async def fake_handle_tool_call(tool_name, tool_input, mcp_manager):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        yield {"type": "tool_execution_complete", "tool": tool_name, "result": []}
+
+    monkeypatch.setattr(response_generator, "handle_tool_call", fake_handle_tool_call)
+    monkeypatch.setattr(response_generator, "MAX_PARALLEL_TOOL_CALLS", 2)
+    tool_calls = [("web_search", {"q": str(i)}) for i in range(6)]
+
+    async def run():
+        return await _collect(_run_tool_calls(tool_calls, None))
+
+    updates = asyncio.run(run())
+    assert len(updates) == len(tool_calls)
+    assert peak == 2
+
+
+def test_run_tool_calls_deduplicates_identical_calls(monkeypatch):
+    """Identical calls run once and their status updates are delivered to every duplicate."""
+    executed = []
+
+    async def fake_handle_tool_call(tool_name, tool_input, mcp_manager):
+        executed.append((tool_name, tool_input))
+        yield {"type": "tool_execution", "tool": tool_name, "input": tool_input}
+        yield {"type": "tool_execution_complete", "tool": tool_name, "result": [tool_input["q"]]}
+
+    monkeypatch.setattr(response_generator, "handle_tool_call", fake_handle_tool_call)
+    tool_calls = [
+        ("web_search", {"q": "a", "n": 1}),
+        ("web_search", {"n": 1, "q": "a"}),
+        ("web_search", {"q": "b", "n": 1}),
+    ]
+
+    async def run():
+        return await _collect(_run_tool_calls(tool_calls, None))
+
+    updates = asyncio.run(run())
+    assert sorted(executed, key=lambda call: call[1]["q"]) == [tool_calls[0], tool_calls[2]]
+    results = {index: status["result"] for index, status in updates if status["type"] == "tool_execution_complete"}
+    assert results == {0: ["a"], 1: ["a"], 2: ["b"]}
+
+
+def test_read_ahead_early_break_stops_pump():
+    """Leaving the loop early stops the pump before the upstream stream is closed."""
+    state = {"iterating": False, "closed_while_iterating": None}
+
+    class FakeStream:
+        def __aiter__(self):
+            return self._events()
+
+        async def _events(self):
+            state["iterating"] = True
+            try:
+                for i in range(100):
+                    await asyncio.sleep(0)
+                    yield i
+            finally:
+                state["iterating"] = False
+
+        async def close(self):
+            state["closed_while_iterating"] = state["iterating"]
+
+    async def run():
+        stream = FakeStream()
+        received = []
+        async with aclosing(_read_ahead(stream, max_items=2)) as events:
+            async for event in events:
+                received.append(event)
+                if event == 2:
+                    break
+        await stream.close()
+        other_tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        return received, other_tasks
+
+    received, other_tasks = asyncio.run(run())
+    assert received == [0, 1, 2]
+    assert state["closed_while_iterating"] is False
+    assert not other_tasks
+
+
+def test_run_tool_calls_close_cancels_running_tools(monkeypatch):
+    """Closing the generator early cancels and awaits the tools still running."""
+    state = {"cancelled": False}
+
+    async def fake_handle_tool_call(tool_name, tool_input, mcp_manager):
+        yield {"type": "tool_execution", "tool": tool_name, "input": tool_input}
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+        yield {"type": "tool_execution_complete", "tool": tool_name, "result": []}
+
+    monkeypatch.setattr(response_generator, "handle_tool_call", fake_handle_tool_call)
+
+    async def run():
+        async with aclosing(_run_tool_calls([("web_search", {"q": "a"})], None)) as tool_statuses:
+            async for index, status in tool_statuses:
+                break
+        return asyncio.all_tasks() - {asyncio.current_task()}
+
+    other_tasks = asyncio.run(run())
+    assert state["cancelled"]
+    assert not other_tasks
+
+
+def test_coalesce_flushes_text_on_non_text_frame():
+    """Buffered text is written together with the first non-text frame."""
+    tool_frame = _tool_call_start("web_search")
+
+    async def source():
+        yield _text_frame("Hello")
+        yield _text_frame(" world")
+        yield tool_frame
+        yield _text_frame("done")
+        yield _DONE
+
+    async def run():
+        return await _collect(_coalesce(source(), max_delay_ms=10_000))
+
+    writes = asyncio.run(run())
+    assert writes == [
+        _text_frame("Hello") + _text_frame(" world") + tool_frame,
+        _text_frame("done") + _DONE,
+    ]
+
+
+def test_coalesce_flushes_on_timeout_and_closes_source():
+    """Buffered text is sent after max_delay_ms when the source stalls, and closing stops the source."""
+    state = {"closed": False}
+
+    async def source():
+        try:
+            yield _text_frame("Hello")
+            await asyncio.sleep(10)
+            yield _DONE
+        finally:
+            state["closed"] = True
+
+    async def run():
+        coalesced = _coalesce(source(), max_delay_ms=10)
+        first_write = await asyncio.wait_for(anext(coalesced), timeout=1)
+        await coalesced.aclose()
+        return first_write, asyncio.all_tasks() - {asyncio.current_task()}
+
+    first_write, other_tasks = asyncio.run(run())
+    assert first_write == _text_frame("Hello")
+    assert state["closed"]
+    assert not other_tasks